@@ -20,6 +20,10 @@ Usage examples: (see command line below, too)
   python adsr_sine.py --freq 440 --attack 0.01 --decay 0.2 --sustain-level 0.6 \
   --sustain 0.5 --release 0.3 --sr 48000 --report-stats \
   --outfile tone.wav --csv-outfile tone.csv --csv-downsample 100 --vpp 0.8 --plot
+
+  # Save raw uint16 DAC codes for arb_waveform.py (much faster to write and read than the CSV)
+  python adsr_sine.py --freq 440 --attack 0.01 --decay 0.2 --sustain-level 0.6 --sustain 0.5 --release 0.3 \
+    --raw-u16-outfile tone.u16
 """
 
 import argparse
@@ -31,11 +35,14 @@ from typing import Tuple, Optional
 
 import numpy as np
 
-try:
-    import matplotlib.pyplot as plt
-    _HAVE_PLOT = True
-except Exception:
-    _HAVE_PLOT = False
+# Signal arrays (envelope, sine, output) are float32: the final sink is 16-bit PCM, so float64 only doubles the
+# memory traffic. Time vectors stay float64 for resolution on long tones.
+_SAMPLE_DTYPE = np.float32
+
+_WAV_CHUNK_FRAMES = 1 << 16  # frames converted and written per write_wav_pcm16 iteration
+_CSV_BLOCK_ROWS = 4096       # rows formatted per write in write_csv
+_CSV_FLOAT_FMT = "%.10g"     # plenty for microsecond time stamps and 16-bit DAC levels
+_PLOT_MAX_POINTS = 10000     # envelope points drawn by --plot
 
 
 @dataclass
@@ -50,89 +57,217 @@ class ADSR:
         return max(0.0, self.attack) + max(0.0, self.decay) + max(0.0, self.sustain) + max(0.0, self.release)
 
 
-def _segment(start: float, stop: float, n: int) -> np.ndarray:
-    """Inclusive-exclusive linspace-like segment (start..stop, n samples)."""
+@dataclass
+class SynthResult:
+    y: np.ndarray                          # shaped output samples
+    sr: int                                # sample rate (Hz)
+    env: Optional[np.ndarray] = None       # envelope, 0..1 (only with keep_components)
+    sine_raw: Optional[np.ndarray] = None  # unshaped sine (only with keep_components)
+    t: Optional[np.ndarray] = None         # time vector in seconds (only with keep_components)
+
+
+def _segment(out: np.ndarray, start: float, stop: float, idx: np.ndarray) -> None:
+    """
+    Fill out in place with an inclusive-exclusive linspace-like segment (start..stop, out.size samples).
+
+    idx is a shared np.arange at least out.size long, so several segments can be written from one index buffer.
+    """
+    n = out.size
     if n <= 0:
-        return np.empty(0, dtype=np.float64)
-    # Use endpoint=False and append stop at the boundary via next segment to avoid duplicate samples.
-    return np.linspace(start, stop, num=n, endpoint=False, dtype=np.float64)
+        return
+    # Same arithmetic as np.linspace(start, stop, n, endpoint=False); stop is reached by the next segment.
+    np.multiply(idx[:n], (stop - start) / n, out=out)
+    out += start
+
 
+def _segment_counts(adsr: ADSR, sr: int) -> Tuple[int, int, int, int]:
+    """Number of samples in the attack, decay, sustain and release segments."""
+    return (int(round(max(0.0, adsr.attack) * sr)),
+            int(round(max(0.0, adsr.decay) * sr)),
+            int(round(max(0.0, adsr.sustain) * sr)),
+            int(round(max(0.0, adsr.release) * sr)))
 
-def adsr_envelope(adsr: ADSR, sr: int) -> Tuple[np.ndarray, np.ndarray]:
+
+def adsr_envelope(adsr: ADSR, sr: int, return_time: bool = True) -> Tuple[np.ndarray, Optional[np.ndarray]]:
     """
     Build a linear ADSR envelope.
 
     Returns:
       env: shape (N,), values in [0,1]
-      t:   shape (N,), time vector in seconds (monotonic, last sample < total_duration)
+      t:   shape (N,), time vector in seconds (monotonic, last sample < total_duration), or None when
+           return_time is False
     """
     if sr <= 0:
         raise ValueError("Sample rate must be positive.")
-    a_n = int(round(max(0.0, adsr.attack) * sr))
-    d_n = int(round(max(0.0, adsr.decay) * sr))
-    s_n = int(round(max(0.0, adsr.sustain) * sr))
-    r_n = int(round(max(0.0, adsr.release) * sr))
-
-    # Build segments
-    a_seg = _segment(0.0, 1.0, a_n)                       # 0 -> 1
-    d_seg = _segment(1.0, adsr.sustain_level, d_n)        # 1 -> sustain
-    s_seg = np.full(s_n, adsr.sustain_level, dtype=np.float64)  # sustain hold
-    r_seg = _segment(adsr.sustain_level, 0.0, r_n)        # sustain -> 0
-
-    env = np.concatenate([a_seg, d_seg, s_seg, r_seg])
-    # Time vector aligned with samples
-    t = np.arange(env.size, dtype=np.float64) / sr
+    a_n, d_n, s_n, r_n = _segment_counts(adsr, sr)
+
+    # Write each segment straight into one preallocated buffer
+    a_end = a_n
+    d_end = a_end + d_n
+    s_end = d_end + s_n
+    env = np.empty(s_end + r_n, dtype=_SAMPLE_DTYPE)
+    idx = np.arange(max(a_n, d_n, r_n), dtype=np.float64)
+    _segment(env[:a_end], 0.0, 1.0, idx)                       # 0 -> 1
+    _segment(env[a_end:d_end], 1.0, adsr.sustain_level, idx)   # 1 -> sustain
+    env[d_end:s_end].fill(adsr.sustain_level)                  # sustain hold (one memset, no temporary)
+    _segment(env[s_end:], adsr.sustain_level, 0.0, idx)        # sustain -> 0
+
     # Clip any numerical overshoot
     np.clip(env, 0.0, 1.0, out=env)
+    if not return_time:
+        return env, None
+    # Time vector aligned with samples
+    t = np.arange(env.size, dtype=np.float64) / sr
     return env, t
 
 
 def sine_wave(freq: float, duration: float, sr: int, phase: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
     """Generate a pure sine of given duration. Returns (x, t)."""
-    if freq <= 0:
-        raise ValueError("Frequency must be positive.")
-    if sr <= 0:
-        raise ValueError("Sample rate must be positive.")
     n = int(round(max(0.0, duration) * sr))
+    x = _sine_samples(freq, n, sr, phase)
     t = np.arange(n, dtype=np.float64) / sr
-    x = np.sin(2.0 * math.pi * freq * t + phase, dtype=np.float64)
     return x, t
 
 
-def synth_adsr_sine(freq: float, adsr: ADSR, sr: int = 48000, amplitude: float = 0.9, phase: float = 0.0) -> Tuple[np.ndarray, int]:
+def _sine_samples(freq: float, n: int, sr: int, phase: float = 0.0) -> np.ndarray:
+    """
+    n samples of a pure sine, without the time vector.
+
+    Rather than one sin() call per sample, the signal is laid out as a (blocks x block) grid and built with the
+    angle-addition identity sin(a + b) = sin(a)cos(b) + cos(a)sin(b). Only ~2*sqrt(N) transcendentals are needed
+    and the rest is multiply-adds. Each block restarts from an exact phase, so there is no drift like a running
+    phase-accumulator recurrence would have. The sum of the two outer products is a rank-2 matrix product, so
+    it is written by one matmul straight into the output with no N-sized temporaries.
+    """
+    if freq <= 0:
+        raise ValueError("Frequency must be positive.")
+    if sr <= 0:
+        raise ValueError("Sample rate must be positive.")
+    if n <= 0:
+        return np.empty(0, dtype=_SAMPLE_DTYPE)
+    omega = 2.0 * math.pi * freq / sr
+    block = max(1, math.isqrt(n))
+    blocks = -(-n // block)
+    inner = np.arange(block, dtype=np.float64) * omega                # phase within a block
+    outer = np.arange(blocks, dtype=np.float64) * (omega * block) + phase  # phase at the start of each block
+    # Phases and their sin/cos are kept in float64 (only ~2*sqrt(N) of them); the N-sized grid is float32.
+    lhs = np.empty((blocks, 2), dtype=_SAMPLE_DTYPE)
+    lhs[:, 0] = np.sin(outer)
+    lhs[:, 1] = np.cos(outer)
+    rhs = np.empty((2, block), dtype=_SAMPLE_DTYPE)
+    rhs[0] = np.cos(inner)
+    rhs[1] = np.sin(inner)
+    grid = np.empty((blocks, block), dtype=_SAMPLE_DTYPE)
+    np.matmul(lhs, rhs, out=grid)
+    return grid.reshape(-1)[:n]
+
+
+def synth_adsr_sine(freq: float, adsr: ADSR, sr: int = 48000, amplitude: float = 0.9, phase: float = 0.0,
+                    keep_components: bool = False) -> SynthResult:
     """
     Create an ADSR-shaped sine tone.
-    Returns:
-      y: float64 audio samples in [-1, 1)
+    Returns a SynthResult with:
+      y:  float32 audio samples in [-1, 1)
       sr: sample rate
+    With keep_components=True the envelope, raw sine and time vector used to build y are returned as well (all the
+    same length as y), so callers don't have to regenerate them for CSV export or plotting.
     """
     if not (0.0 <= amplitude <= 1.0):
         raise ValueError("Amplitude must be in [0, 1].")
+    if not (0.0 <= adsr.sustain_level <= 1.0):
+        raise ValueError("Sustain level must be in [0, 1].")
     # Rule-of-thumb: at least 8× oversampling vs. frequency for nice plots; Nyquist requires >= 2×.
     if sr < 2 * freq:
         print(f"Warning: sample rate {sr} Hz is below Nyquist for {freq} Hz. Increase sr to >= {2*freq:.0f} Hz.",
               file=sys.stderr)
-    env, _ = adsr_envelope(adsr, sr)
-    x, _ = sine_wave(freq, adsr.total_duration(), sr, phase=phase)
-    n = min(env.size, x.size)
-    y = amplitude * env[:n] * x[:n]
-    return y.astype(np.float64, copy=False), sr
+    x = _sine_samples(freq, int(round(adsr.total_duration() * sr)), sr, phase=phase)
+    if not keep_components:
+        return SynthResult(y=_apply_envelope(x, adsr, sr, amplitude), sr=sr)
+    # y is shaped the same fused way as above (on a copy, since the raw sine is returned too), so the CSV/plot
+    # waveform is bit-identical to the WAV one and amplitude*env*x never needs full-size temporaries.
+    y = _apply_envelope(x.copy(), adsr, sr, amplitude)
+    n = y.size
+    env, _ = adsr_envelope(adsr, sr, return_time=False)
+    env = env[:n]
+    t = np.arange(n, dtype=np.float64) / sr
+    return SynthResult(y=y, sr=sr, env=env, sine_raw=x[:n], t=t)
+
+
+def _apply_envelope(x: np.ndarray, adsr: ADSR, sr: int, amplitude: float) -> np.ndarray:
+    """
+    Shape x in place by amplitude * ADSR envelope, one segment at a time.
+
+    Same result as amplitude * adsr_envelope(adsr, sr)[0] * x, but the full-length envelope is never built. The
+    sustain hold is a scalar multiply and only the ramps need a (segment-sized) temporary. Returns the shaped
+    samples, truncated to the shorter of x and the envelope. Expects a sustain level in [0, 1] (checked by
+    synth_adsr_sine), where adsr_envelope's final clip is a no-op.
+    """
+    a_n, d_n, s_n, r_n = _segment_counts(adsr, sr)
+    level = adsr.sustain_level
+    y = x[:min(x.size, a_n + d_n + s_n + r_n)]
+    ramp_n = max(a_n, d_n, r_n)
+    idx = np.arange(ramp_n, dtype=np.float64)
+    ramp = np.empty(ramp_n, dtype=_SAMPLE_DTYPE)
+    start = 0
+    for seg_start, seg_stop, seg_n in ((0.0, 1.0, a_n), (1.0, level, d_n), (level, level, s_n), (level, 0.0, r_n)):
+        seg = y[start:start + seg_n]
+        if seg.size:
+            if seg_start == seg_stop:
+                seg *= amplitude * seg_start
+            else:
+                _segment(ramp[:seg_n], amplitude * seg_start, amplitude * seg_stop, idx)
+                seg *= ramp[:seg.size]
+        start += seg_n
+    return y
 
 
 def write_wav_pcm16(path: str, samples: np.ndarray, sr: int) -> None:
     """Write mono WAV PCM16 using stdlib 'wave' to avoid extra deps."""
-    # Normalize to [-1, 1) just in case then convert to int16
-    s = np.asarray(samples, dtype=np.float64)
-    max_mag = np.max(np.abs(s)) if s.size else 1.0
-    if max_mag > 1.0:
-        s = s / max_mag
-    s16 = np.clip(np.round(s * 32767.0), -32768, 32767).astype(np.int16)
-
+    # Normalize to [-1, 1) just in case; the normalization is folded into the PCM scale factor.
+    s = np.asarray(samples)
+    if s.dtype not in (np.float32, np.float64):
+        s = s.astype(np.float64)
+    max_mag = max(float(s.max()), -float(s.min())) if s.size else 1.0
+    scale = 32767.0 / max_mag if max_mag > 1.0 else 32767.0
+
+    # Convert and write in fixed-size chunks, reusing the same two scratch buffers, so peak memory stays at
+    # one chunk rather than a full int16 copy plus a bytes copy of the whole signal.
+    chunk = max(1, min(_WAV_CHUNK_FRAMES, s.size))
+    buf = np.empty(chunk, dtype=s.dtype)
+    s16 = np.empty(chunk, dtype=np.int16)
     with wave.open(path, 'wb') as wf:
         wf.setnchannels(1)
         wf.setsampwidth(2)  # 16-bit
         wf.setframerate(sr)
-        wf.writeframes(s16.tobytes())
+        for start in range(0, s.size, chunk):
+            m = min(chunk, s.size - start)
+            np.multiply(s[start:start + m], scale, out=buf[:m])
+            np.rint(buf[:m], out=buf[:m])
+            np.clip(buf[:m], -32768, 32767, out=buf[:m])
+            s16[:m] = buf[:m]
+            wf.writeframesraw(s16[:m])
+        wf.writeframes(b"")  # patch the header with the final frame count
+
+
+def write_raw_u16(path: str, samples: np.ndarray) -> None:
+    """
+    Write raw little-endian uint16 DAC codes (-1..1 maps to 0..65535), as read by arb_waveform.read_waveform_raw_u16.
+
+    Same peak normalization as write_wav_pcm16. This is the fast, exact bridge to the arb generator; the CSV is
+    meant for looking at the waveform.
+    """
+    s = np.asarray(samples)
+    if s.dtype not in (np.float32, np.float64):
+        s = s.astype(np.float64)
+    max_mag = max(float(s.max()), -float(s.min())) if s.size else 1.0
+    scale = 1.0 / max_mag if max_mag > 1.0 else 1.0
+    # Same arithmetic as arb_waveform.read_waveform_csv: round((v + 1) * 32767.5), in one reused buffer
+    buf = np.multiply(s, scale, dtype=np.float64)
+    buf += 1.0
+    buf *= 32767.5
+    np.rint(buf, out=buf)
+    np.clip(buf, 0, 65535, out=buf)
+    buf.astype('<u2').tofile(path)
 
 
 def write_csv(path: str, t: np.ndarray, env: np.ndarray, sine: np.ndarray, y: np.ndarray, sr: int, downsample: int = 1, meta: Optional[str] = None) -> None:
@@ -140,10 +275,17 @@ def write_csv(path: str, t: np.ndarray, env: np.ndarray, sine: np.ndarray, y: np
     import numpy as np
     n = min(t.size, env.size, sine.size, y.size)
     step = max(1, downsample)
-    idx = np.arange(0, n, step)
-    data = np.column_stack([t[idx], env[idx], sine[idx], y[idx]])
+    # Strided slices are views, so the only copy made is the one column_stack does anyway
+    data = np.column_stack([t[:n:step], env[:n:step], sine[:n:step], y[:n:step]])
     header = f"time_sec,envelope,sine_raw,waveform\n# sample_rate={sr}Hz, csv_downsample={downsample}"
-    np.savetxt(path, data, delimiter=",", header=header, comments="")
+    # Rows are formatted a block at a time with a single %-operation instead of np.savetxt's per-row formatting,
+    # and with 10 significant digits rather than savetxt's 19 (%.18e), which was most of the formatting cost.
+    row_fmt = ",".join([_CSV_FLOAT_FMT] * data.shape[1]) + "\n"
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for start in range(0, data.shape[0], _CSV_BLOCK_ROWS):
+            block = data[start:start + _CSV_BLOCK_ROWS]
+            f.write((row_fmt * block.shape[0]) % tuple(block.ravel().tolist()))
 
 def main(argv=None) -> int:
     ap = argparse.ArgumentParser(description="Generate an ADSR-envelope-shaped sine wave.")
@@ -161,6 +303,7 @@ def main(argv=None) -> int:
     ap.add_argument("--plot", action="store_true", help="Show plots (requires matplotlib)")
     ap.add_argument("--report-stats", action="store_true", help="Print min/max/Vpp summary of the final waveform")
     ap.add_argument("--csv-outfile", type=str, default=None, help="Optional CSV output path (time,envelope,sine_raw,waveform)")
+    ap.add_argument("--raw-u16-outfile", type=str, default=None, help="Optional raw uint16 output path for arb_waveform.py (little-endian DAC codes)")
     ap.add_argument("--csv-downsample", type=int, default=1, help="Downsample factor for CSV (default=1, i.e. no downsampling)")
 
     args = ap.parse_args(argv)
@@ -176,24 +319,24 @@ def main(argv=None) -> int:
         release=max(0.0, args.release),
     )
 
-    y, sr = synth_adsr_sine(args.freq, adsr, sr=args.sr, amplitude=args.amplitude, phase=args.phase)
+    # Envelope/sine/time are only kept when something downstream needs them
+    result = synth_adsr_sine(args.freq, adsr, sr=args.sr, amplitude=args.amplitude, phase=args.phase,
+                             keep_components=bool(args.csv_outfile or args.plot))
+    y, sr = result.y, result.sr
     # Apply optional Vpp scaling to the final waveform
     vpp_target = args.vpp
     vpp_measured = None
     if y.size:
-        # y_min = float(np.min(y))
-        # y_max = float(np.max(y))
-        y_min = float(min(y))
-        y_max = float(max(y))
+        y_min = float(y.min())
+        y_max = float(y.max())
         vpp_measured = y_max - y_min
         if vpp_target is not None and vpp_target > 0 and vpp_measured > 0:
+            # Scale in place (no second full-size array). The scale is positive, so the new stats follow
+            # directly from the old ones without another pass over the signal.
             scale = vpp_target / vpp_measured
-            y = y * scale
-            # Recompute stats after scaling
-            # y_min = float(np.min(y))
-            # y_max = float(np.max(y))
-            y_min = float(min(y))
-            y_max = float(max(y))
+            y *= scale
+            y_min *= scale
+            y_max *= scale
             vpp_measured = y_max - y_min
     else:
         y_min = y_max = 0.0
@@ -203,28 +346,34 @@ def main(argv=None) -> int:
         print(f"Waveform stats: min={y_min:.6f}, max={y_max:.6f}, Vpp={vpp_measured:.6f}")
 
     if args.csv_outfile:
-        env, t = adsr_envelope(adsr, sr)
-        sine_raw, _ = sine_wave(args.freq, adsr.total_duration(), sr, phase=args.phase)
         meta = f"vpp_target={args.vpp}, vpp_measured={vpp_measured:.6f}"
-        write_csv(args.csv_outfile, t, env, sine_raw, y, sr, downsample=args.csv_downsample, meta=meta)
+        write_csv(args.csv_outfile, result.t, result.env, result.sine_raw, y, sr, downsample=args.csv_downsample,
+                  meta=meta)
         print(f"Wrote CSV {args.csv_outfile} ({y.size} samples @ {sr} Hz)")
 
+    if args.raw_u16_outfile:
+        write_raw_u16(args.raw_u16_outfile, y)
+        print(f"Wrote raw uint16 {args.raw_u16_outfile} ({y.size} samples @ {sr} Hz)")
+
     if args.outfile:
         write_wav_pcm16(args.outfile, y, sr)
         print(f"Wrote {args.outfile} ({y.size} samples @ {sr} Hz)")
 
     if args.plot:
-        if not _HAVE_PLOT:
+        # matplotlib is only imported when plotting, so it doesn't add to start-up time on the other paths
+        try:
+            import matplotlib.pyplot as plt
+        except Exception:
+            plt = None
+        if plt is None:
             print("matplotlib not available; cannot plot.", file=sys.stderr)
         else:
             # Plot envelope and a short segment of waveform for clarity
-            import matplotlib.pyplot as plt
-            import numpy as np
 
-            # Recompute envelope/time for plotting
-            env, t = adsr_envelope(adsr, sr)
-            n = min(env.size, y.size)
-            env = env[:n]; t = t[:n]
+            # Envelope/time come from the synthesis pass. Stride them down to at most _PLOT_MAX_POINTS, which is
+            # still far more than the screen can show and keeps long tones quick to render.
+            step = max(1, -(-result.env.size // _PLOT_MAX_POINTS))
+            env, t = result.env[::step], result.t[::step]
 
             plt.figure()
             plt.title("ADSR Envelope")
@@ -2,7 +2,7 @@ import numpy as np
 import pyvisa
 
 WAVEFORM_GENERATOR_ADDRESS = 'TCPIP::192.168.1.89::INSTR'
-CSV_FILE = 'waveform.csv'  # Update with your CSV filename
+CSV_FILE = 'waveform.csv'  # Update with your CSV filename (or a .u16 file from adsr_sine.py --raw-u16-outfile)
 WAVEFORM_NAME = 'USER1'
 
 '''
@@ -10,35 +10,50 @@ WAVEFORM_NAME = 'USER1'
 '''
 
 def read_waveform_csv(filename):
-    # Assumes a single column of values between -1 and 1
-    data = np.loadtxt(filename, delimiter=',')
-    # Scale to 16-bit unsigned integer (0 to 65535)
-    scaled = np.round((data + 1) * 32767.5).astype(np.uint16)
+    # Assumes a single column of values between -1 and 1. A .npy file holding the same values is also accepted;
+    # it loads with one read and no text parsing, which matters for million-sample waveforms.
+    if filename.endswith('.npy'):
+        data = np.load(filename)
+    else:
+        data = np.loadtxt(filename, delimiter=',', ndmin=1)
+    # Scale to 16-bit unsigned integer (0 to 65535), reusing one float buffer for the add, multiply and round
+    buf = np.add(data, 1.0, dtype=np.float64)
+    buf *= 32767.5
+    np.rint(buf, out=buf)
+    scaled = buf.astype(np.uint16)
     return scaled
 
+def read_waveform_raw_u16(filename):
+    # Raw little-endian uint16 DAC codes, e.g. from adsr_sine.py --raw-u16-outfile. Already scaled, so this is
+    # a single read with no parsing.
+    return np.fromfile(filename, dtype='<u2').astype(np.uint16, copy=False)
+
 def upload_waveform_to_awg(waveform_data, name=WAVEFORM_NAME):
     rm = pyvisa.ResourceManager()
     inst = rm.open_resource(WAVEFORM_GENERATOR_ADDRESS)
     inst.timeout = 10000  # ms
 
-    # Convert to comma-separated string
-    data_str = ','.join(map(str, waveform_data))
-
-    # Delete existing user waveform if needed
-    inst.write(f":DATA:VOLatile:DELete '{name}'")
+    # Each write is a full round trip to the instrument, so related commands are sent as one ';'-compounded
+    # SCPI message. Delete any existing user waveform and set the byte order (the binary block below goes out
+    # little-endian) in one message.
+    inst.write(f":DATA:VOLatile:DELete '{name}';:FORMat:BORDer SWAP")
 
-    # Send the waveform data
-    inst.write(f":DATA:ARB:DAC {name},{data_str}")
+    # Send the waveform data as one IEEE-488.2 definite-length binary block (#<digits><count><bytes>) rather than
+    # a comma-separated ASCII list. pyvisa packs the array with a single memcpy. DATA:ARB:DAC takes signed
+    # codes (-32767 to 32767), so the offset-binary uint16 codes are shifted down first.
+    codes = (waveform_data.astype(np.int32) - 32768).clip(-32767, 32767).astype(np.int16)
+    inst.write_binary_values(f":DATA:ARB:DAC {name},", codes, datatype='h', is_big_endian=False)
 
-    # Set the waveform to output
-    inst.write(f":FUNCtion:ARB {name}")
-    inst.write(":FUNCtion ARB")
-    inst.write(":OUTPut ON")
+    # Select the waveform and turn the output on, with *OPC? on the end so this returns once it's all done
+    inst.query(f":FUNCtion:ARB {name};:FUNCtion ARB;:OUTPut ON;*OPC?")
 
     print(f"Waveform '{name}' uploaded and output enabled.")
 
 def main():
-    waveform = read_waveform_csv(CSV_FILE)
+    if CSV_FILE.endswith('.u16'):
+        waveform = read_waveform_raw_u16(CSV_FILE)
+    else:
+        waveform = read_waveform_csv(CSV_FILE)
     upload_waveform_to_awg(waveform)
 
 if __name__ == "__main__":
@@ -1,15 +1,41 @@
+import asyncio
+import atexit
+import contextlib
+import math
+import os
+import re
+import socket
+import sqlite3
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 import pyvisa
+from pyvisa import constants
 import numpy as np
+import matplotlib
+
+# Set BODE_BATCH=1 to run headless: the Bode plot is saved to BODE_PLOT_FILE instead of opening a window
+BATCH_MODE = bool(os.environ.get('BODE_BATCH'))
+BODE_PLOT_FILE = 'bode.png'
+if BATCH_MODE:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
+# The SOCKET addresses are raw SCPI over TCP. That skips the VXI-11 RPC framing on every command, which makes
+# command/response traffic faster. Everything in bode_plot works over either kind of connection. get_resource sets
+# the terminations SOCKET needs, and the scope falls back to polling since there's no SRQ over a raw socket.
 POWER_SUPPLY_ADDRESS = 'TCPIP::192.168.1.122::INSTR'
 # POWER_SUPPLY_ADDRESS = 'TCPIP::192.168.1.122::5025::SOCKET'
 WAVEFORM_GENERATOR_ADDRESS = 'TCPIP::192.168.1.227::INSTR'
+# WAVEFORM_GENERATOR_ADDRESS = 'TCPIP::192.168.1.227::5025::SOCKET'
 RIGOL_OSCILLOSCOPE_ADDRESS = 'TCPIP::192.168.1.226::INSTR'
+# RIGOL_OSCILLOSCOPE_ADDRESS = 'TCPIP::192.168.1.226::5555::SOCKET'
 SIGLENT_OSCILLOSCOPE_ADDRESS = 'TCPIP::192.168.1.22::INSTR'
 # SIGLENT_OSCILLOSCOPE_ADDRESS = 'TCPIP::192.168.1.22::5025::SOCKET'
 DMM_ADDRESS = 'TCPIP::192.168.1.248::INSTR'
+# DMM_ADDRESS = 'TCPIP::192.168.1.248::5025::SOCKET'
 
 '''
     My setup. The HISLIP adapter is apparently a high-speed interface layer for VISA. I haven't used it yet.
@@ -56,30 +82,40 @@ def list_instruments():
     actually instruments. So those are filtered out by looking for 'INSTR' in the resource string.
     '''
     
-    rm_py = pyvisa.ResourceManager('@py')
-    print(rm_py.list_resources('TCPIP?'))
+    rm_py = get_rm('@py')
+    # Discovery is a network broadcast and takes seconds, so do it once and reuse the result
+    resources = tuple(rm_py.list_resources('TCPIP?'))
+    print(resources)
 
-    # This code is for trying SOCKET connections.
+    # This code is for trying SOCKET connections. It reuses the discovery above rather than running another one.
     # ips = []
-    # for r in rm_py.list_resources('TCPIP?*::INSTR'):
-    #     ips.append(r.split('::')[1])
+    # for r in resources:
+    #     if r.endswith('::INSTR'):
+    #         ips.append(r.split('::')[1])
     # print("Found IPs:", ips)
 
     # The NI-VISA backend is called "ivi" rather than "ni" on macOS for some reason. It can also be referenced directly.
-    # rm_ni = pyvisa.ResourceManager('/Library/Frameworks/VISA.framework/VISA')
-    rm_ni = pyvisa.ResourceManager('@ivi')
+    # get_rm('/Library/Frameworks/VISA.framework/VISA')
 
-    for instrument in rm_py.list_resources('TCPIP?'):
+    # The connections go in the shared pool, so the sample functions (also on '@ivi') reuse them afterwards. The
+    # instruments are probed in parallel, so a missing one costs one open timeout in total rather than one each.
+    def probe(instrument):
         try:
-            resource = rm_ni.open_resource(instrument)
-            print(f"Connected to {instrument}: {resource.query('*IDN?')}")
+            resource = get_resource(instrument, '@ivi')
+            return f"Connected to {instrument}: {resource.query('*IDN?')}"
         except pyvisa.VisaIOError as e:
-            print(f"Could not connect to {instrument}: {e}")
+            return f"Could not connect to {instrument}: {e}"
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for result in executor.map(probe, resources):
+            print(result)
 
     # This code is for trying SOCKET connections.
     # for ip in ips:
     #     rsrc = f'TCPIP0::{ip}::5025::SOCKET'
-    #     inst = rm_ni.open_resource(rsrc)
+    #     check_reachable(rsrc)
+    #     inst = get_rm('@ivi').open_resource(rsrc)
+    #     disable_nagle(inst)
     #     inst.write_termination = '\n'; inst.read_termination = '\n'
     #     print(inst.query('*IDN?').strip())
 
@@ -92,20 +128,182 @@ def list_instruments():
     # print("SOCK2:", rm.list_resources('TCPIP?*::SOCKET'))
 
     # This code is required when using the SOCKET connection, but not with the INSTR connection.
+    # (get_resource() below does this for every connection it opens.)
     # resource = rm.open_resource(POWER_SUPPLY_ADDRESS)
     # resource.read_termination = '\n'
     # resource.write_termination = '\n'
     # resource.timeout = 5000
     
+'''
+    SCPI traffic is lots of tiny writes, which is the worst case for Nagle's algorithm: the kernel holds each small
+    packet back waiting to coalesce it and every query can pick up a delay of up to ~200 ms. This turns it off.
+
+    VISA exposes TCP_NODELAY as VI_ATTR_TCPIP_NODELAY, but only SOCKET resources have to support it. For INSTR
+    (VXI-11) resources on the py backend, the option is set directly on the RPC socket underneath instead. Anything
+    else is left alone.
+'''
+
+def disable_nagle(inst):
+    try:
+        inst.set_visa_attribute(constants.ResourceAttribute.tcpip_nodelay, constants.VI_TRUE)
+        return
+    except (pyvisa.VisaIOError, NotImplementedError, ValueError):
+        pass
+    try:
+        interface = inst.visalib.sessions[inst.session].interface
+    except (AttributeError, KeyError, TypeError):
+        return
+    sock = getattr(interface, 'sock', interface)
+    if isinstance(sock, socket.socket):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+'''
+    Opening a resource manager or an instrument can take a couple of seconds on some backends, so both are opened
+    once per backend/address and reused for the life of the process. Calling bode_plot() again (e.g. from an
+    interactive session while tuning a circuit) then skips reconnecting entirely. Everything is closed at exit.
+
+    Each pooled instrument has its own lock, so worker threads (see write_concurrently below) can talk to different
+    instruments in parallel while two threads can never interleave traffic on the same one.
+
+    Each connection is also configured once when it's opened rather than left on backend defaults: a timeout with
+    headroom for a slow scope (a spurious timeout costs a whole retry cycle), a larger read chunk, and explicit '\n'
+    terminations. SOCKET connections don't work at all without the terminations, and INSTR connections don't mind.
+    With a read termination set, a short SCPI reply ends on its newline in one read. The chunk size only matters for
+    large binary transfers, and some backends allocate a full chunk per read, so raise it just around those.
+
+    open_resource's open_timeout only bounds waiting for a lock on the resource, not connecting to it, so an
+    instrument that's switched off would otherwise hang until the backend's own TCP connect gives up. A LAN address
+    is therefore checked first with a plain TCP connect (bounded by VISA_OPEN_TIMEOUT_MS) to the port the backend
+    will use: the SOCKET port itself, 4880 for HiSLIP, or the portmapper (111) for VXI-11.
+'''
+
+VISA_OPEN_TIMEOUT_MS = 1000  # A LAN instrument that's there accepts a TCP connection well within this
+VISA_TIMEOUT_MS = 5000
+VISA_CHUNK_SIZE = 1 << 16
+
+def check_reachable(address):
+    # Raises VisaIOError if a TCPIP address doesn't accept a connection in time. Other interfaces aren't checked.
+    parts = address.split('::')
+    if not parts[0].upper().startswith('TCPIP') or len(parts) < 3:
+        return
+    host = parts[1]
+    if parts[-1].upper() == 'SOCKET':
+        port = int(parts[2])
+    elif parts[2].lower().startswith('hislip'):
+        port = 4880
+    else:
+        port = 111
+    try:
+        socket.create_connection((host, port), VISA_OPEN_TIMEOUT_MS / 1000).close()
+    except OSError:
+        raise pyvisa.VisaIOError(constants.StatusCode.error_resource_not_found) from None
+
+@dataclass
+class ResourcePool:
+    rms: dict = field(default_factory=dict)        # backend -> ResourceManager
+    resources: dict = field(default_factory=dict)  # (backend, address) -> (resource, lock)
+    guard: threading.Lock = field(default_factory=threading.Lock)
+
+    def get_rm(self, backend=''):
+        with self.guard:
+            if backend not in self.rms:
+                self.rms[backend] = pyvisa.ResourceManager(backend)
+            return self.rms[backend]
+
+    def get(self, address, backend=''):
+        key = (backend, address)
+        with self.guard:
+            entry = self.resources.get(key)
+        if entry is not None:
+            try:
+                entry[0].session  # Raises if the connection was closed behind our back
+                return entry
+            except pyvisa.errors.InvalidSession:
+                pass
+        check_reachable(address)
+        inst = self.get_rm(backend).open_resource(address)
+        inst.timeout = VISA_TIMEOUT_MS
+        inst.chunk_size = VISA_CHUNK_SIZE
+        inst.write_termination = '\n'
+        inst.read_termination = '\n'
+        disable_nagle(inst)
+        entry = (inst, threading.Lock())
+        with self.guard:
+            self.resources[key] = entry
+        return entry
+
+    def release(self, inst):
+        # Close one pooled resource now, e.g. to hand its connection over to something else. It's reopened the next
+        # time it's asked for.
+        with self.guard:
+            for key, (resource, lock) in list(self.resources.items()):
+                if resource is inst:
+                    del self.resources[key]
+                    with lock:
+                        inst.close()
+                    break
+
+    def lock_for(self, inst):
+        with self.guard:
+            for resource, lock in self.resources.values():
+                if resource is inst:
+                    return lock
+        return contextlib.nullcontext()
+
+    def close(self):
+        with self.guard:
+            # One at a time: this runs at exit, and the interpreter won't start new threads once it's shutting down
+            for inst, _ in self.resources.values():
+                try:
+                    inst.close()
+                except Exception:
+                    pass
+            self.resources.clear()
+            for rm in self.rms.values():
+                try:
+                    rm.close()
+                except Exception:
+                    pass
+            self.rms.clear()
+
+_POOL = ResourcePool()
+atexit.register(_POOL.close)
+
+def get_rm(backend=''):
+    return _POOL.get_rm(backend)
+
+def get_resource(address, backend=''):
+    return _POOL.get(address, backend)[0]
+
+def open_instruments(named_addresses):
+    # Opens (name, address) pairs in parallel and returns the resources in the same order. If any can't be opened,
+    # every missing one is reported (not just the first) and None is returned.
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(get_resource, address) for _, address in named_addresses]
+    resources = []
+    for (name, address), future in zip(named_addresses, futures):
+        try:
+            resources.append(future.result())
+        except pyvisa.VisaIOError as e:
+            print(f"Could not connect to {name} at {address}: {e}")
+    return resources if len(resources) == len(named_addresses) else None
+
+def release_resource(inst):
+    _POOL.release(inst)
+
+def resource_lock(inst):
+    # The lock to hold while talking to inst from a worker thread. A no-op for resources that aren't pooled.
+    return _POOL.lock_for(inst)
+
 '''
     Helpful SCPI commands for the instruments.
 '''
 
 def sample_siglent_commands():
 
-    rm = pyvisa.ResourceManager('@ivi')
+    # Connections come from the shared pool (see get_resource above) and stay open until exit
 
-    my_instrument = rm.open_resource(SIGLENT_OSCILLOSCOPE_ADDRESS)
+    my_instrument = get_resource(SIGLENT_OSCILLOSCOPE_ADDRESS, '@ivi')
     # my_instrument.timeout = 5000
     print(my_instrument.query('*IDN?'))
     print(my_instrument.query('C1:PAVA? PKPK'))
@@ -117,13 +315,13 @@ def sample_siglent_commands():
 
 def sample_instrument_commands():
 
-    rm = pyvisa.ResourceManager('@ivi')
+    # Connections come from the shared pool (see get_resource above) and stay open until exit
 
     #
     # Sample setting of voltage on the power supply
     #
 
-    my_instrument = rm.open_resource(POWER_SUPPLY_ADDRESS)
+    my_instrument = get_resource(POWER_SUPPLY_ADDRESS, '@ivi')
     print(my_instrument.query('*IDN?'))
 
     # Set voltage to 5V on the power supply
@@ -140,14 +338,11 @@ def sample_instrument_commands():
     current = my_instrument.query('CURR?')
     print(f'Set Voltage: {voltage} V, Set Current: {current} A')
 
-    # Close the instrument connection
-    my_instrument.close()
-
     #
     # Sample setting a waveform on the waveform generator
     #
 
-    my_instrument = rm.open_resource(WAVEFORM_GENERATOR_ADDRESS)
+    my_instrument = get_resource(WAVEFORM_GENERATOR_ADDRESS, '@ivi')
     print(my_instrument.query('*IDN?'))
 
     # Set waveform to sine, frequency to 1kHz, and amplitude to 1V, and turing the output on
@@ -162,14 +357,11 @@ def sample_instrument_commands():
     amplitude = my_instrument.query('VOLT?')
     print(f'Set Waveform: {waveform}, Frequency: {frequency} Hz, Amplitude: {amplitude} V')
 
-    # Close the instrument connection
-    my_instrument.close()
-
     #
     # Sample reading voltage from the DMM
     #
 
-    my_instrument = rm.open_resource(DMM_ADDRESS)
+    my_instrument = get_resource(DMM_ADDRESS, '@ivi')
     print(my_instrument.query('*IDN?'))
 
     # Set DMM to measure DC voltage
@@ -178,45 +370,263 @@ def sample_instrument_commands():
     voltage = my_instrument.query('READ?')
     print(f'Measured Voltage: {voltage} V')
 
-    # Close the instrument connection
-    my_instrument.close()
-
     #
     # Sample reading waveform data from the Rigol oscilloscope
     #
 
-    my_instrument = rm.open_resource(RIGOL_OSCILLOSCOPE_ADDRESS)  
+    my_instrument = get_resource(RIGOL_OSCILLOSCOPE_ADDRESS, '@ivi')  
     print(my_instrument.query('*IDN?'))
 
-    # # Set oscilloscope to acquire waveform data
-    # my_instrument.write(':WAV:FORM ASC')
-    # my_instrument.write(':WAV:DATA? CHAN1')
-    # # Read the waveform data
-    # waveform_data = my_instrument.query(':WAV:DATA?')
-    # print(f'Waveform Data: {waveform_data}')
+    # # Read the channel 1 waveform as bytes (one binary block straight into a NumPy array, rather than a screen
+    # # of ASCII numbers to parse) and convert it to volts with the preamble's scale and offsets
+    # my_instrument.write(':WAV:SOUR CHAN1;:WAV:MODE NORM;:WAV:FORM BYTE')
+    # preamble = [float(x) for x in my_instrument.query(':WAV:PRE?').split(',')]
+    # y_increment, y_origin, y_reference = preamble[7:10]
+    # waveform_data = my_instrument.query_binary_values(':WAV:DATA?', datatype='B', container=np.array)
+    # waveform_volts = (waveform_data - (y_origin + y_reference)) * y_increment
+    # print(f'Waveform Data: {waveform_volts}')
 
     # Make a Vpp measurement
     vpp = my_instrument.query(':MEASure:ITEM? VPP,CHAN1')
     print(f'Vpp Measurement: {vpp} V')
 
-    # Close the instrument connection
-    my_instrument.close()
-
     #
     # Uncomment the following lines to take a screenshot from the oscilloscope
     #
 
-    # my_instrument = rm.open_resource('TCPIP::192.168.1.252::INSTR')
+    # my_instrument = get_resource('TCPIP::192.168.1.252::INSTR', '@ivi')
     # print(my_instrument.query('*IDN?'))
 
+    # The screenshot is about a megabyte, so read it in one chunk rather than ~16 of the default size
+    # my_instrument.chunk_size = 1 << 20
     # screenshot_data = my_instrument.query_binary_values(':DISP:DATA?', datatype='B', container=bytes)
+    # my_instrument.chunk_size = VISA_CHUNK_SIZE
     # with open('rigol_screenshot.png', 'wb') as f:
     #     f.write(screenshot_data)
 
     # print("Screenshot saved as rigol_screenshot.png")
 
-    # Close the instrument connection
-    # my_instrument.close()
+'''
+    Commands sent at every sweep point can be encoded to bytes once, up front, and sent with write_raw, which skips
+    the per-call string formatting and encoding in write(). write_raw sends the bytes exactly as given, so
+    encode_command adds the instrument's write termination. write_command takes either form.
+'''
+
+def encode_command(inst, command):
+    return (command + inst.write_termination).encode(inst.encoding)
+
+def write_command(inst, command):
+    if isinstance(command, bytes):
+        inst.write_raw(command)
+    else:
+        inst.write(command)
+
+'''
+    Awaitable SCPI queries for the sweep loop.
+
+    query() blocks in viRead for the whole instrument round trip. AsyncQuery issues the read with viReadAsync
+    instead and has VISA's I/O-completion event (VI_EVENT_IO_COMPLETION) fire a callback that resolves an asyncio
+    future, so the sweep coroutine just awaits the reply and doesn't hold the thread in a blocking read.
+
+    Not every backend supports this (the py backend doesn't, and neither does GPIB on some adapters). In that case,
+    or when use_async_reads is False, it quietly falls back to a plain blocking write and read, run on a worker
+    thread (under the resource's lock) so the event loop is still free to drive the other instruments meanwhile.
+
+    Pass raw=True to get the reply as undecoded bytes, e.g. for the regex parsers below. write_raw() sends a
+    pre-encoded command with no reply.
+'''
+
+class AsyncQuery:
+    def __init__(self, inst, use_async_reads=True, max_response=256):
+        self.inst = inst
+        self.max_response = max_response
+        self._future = None
+        self._handler = None
+        if use_async_reads:
+            try:
+                self._handler = inst.install_handler(constants.EventType.io_completion, self._on_io_completion)
+                inst.enable_event(constants.EventType.io_completion, constants.EventMechanism.handler)
+            except (pyvisa.VisaIOError, NotImplementedError, AttributeError):
+                self._handler = None
+
+    def _on_io_completion(self, session, event_type, context, user_handle):
+        # Runs on a VISA thread, so hand the result back to the event loop thread-safely
+        ret_count = self.inst.visalib.get_attribute(context, constants.VI_ATTR_RET_COUNT)[0]
+        future = self._future
+        future.get_loop().call_soon_threadsafe(future.set_result, ret_count)
+
+    async def __call__(self, command, raw=False):
+        if self._handler is None:
+            return await asyncio.to_thread(self._blocking_query, command, raw)
+        self._future = asyncio.get_running_loop().create_future()
+        write_command(self.inst, command)
+        buffer, _, _ = self.inst.visalib.read_asynchronously(self.inst.session, self.max_response)
+        ret_count = await self._future
+        reply = bytes(buffer)[:ret_count]
+        return reply if raw else reply.decode(self.inst.encoding)
+
+    def _blocking_query(self, command, raw):
+        with resource_lock(self.inst):
+            write_command(self.inst, command)
+            return self.inst.read_raw() if raw else self.inst.read()
+
+    def write_raw(self, data):
+        self.inst.write_raw(data)
+
+    def close(self):
+        if self._handler is not None:
+            self.inst.disable_event(constants.EventType.io_completion, constants.EventMechanism.handler)
+            self.inst.uninstall_handler(constants.EventType.io_completion, self._on_io_completion, self._handler)
+            self._handler = None
+
+'''
+    A bare asyncio transport for raw SCPI sockets (TCPIP::host::port::SOCKET). Over a socket SCPI is just newline
+    terminated lines, so the sweep can talk to the scope through a StreamReader/StreamWriter and await each reply
+    directly, with no VISA layer or worker thread in between. It has the same interface as AsyncQuery, so the sweep
+    doesn't care which one it has. There's no SRQ over a raw socket, so with this the sweep polls TRIG:STAT?.
+    (asyncio turns Nagle off on its TCP connections already.)
+'''
+
+class ScpiStream:
+    def __init__(self, reader, writer, encoding='ascii'):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+
+    @classmethod
+    async def open(cls, address):
+        _, host, port, _ = address.split('::')
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), VISA_OPEN_TIMEOUT_MS / 1000)
+        return cls(reader, writer)
+
+    async def __call__(self, command, raw=False):
+        self.write_raw(command if isinstance(command, bytes) else (command + '\n').encode(self.encoding))
+        reply = await asyncio.wait_for(self.reader.readuntil(b'\n'), VISA_TIMEOUT_MS / 1000)
+        return reply if raw else reply.decode(self.encoding).rstrip('\n')
+
+    def write_raw(self, data):
+        self.writer.write(data)  # Buffered and sent in order by the event loop, no need to wait on it
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+'''
+    Waiting for a Siglent acquisition without polling.
+
+    Polling TRIG:STAT? costs a network round trip every 50 ms while the scope acquires. Instead, the scope is set to
+    raise a service request (SRQ) when a new acquisition completes (INR bit 0, enabled with INE and summarized into
+    the status byte with *SRE), and VISA blocks in wait_on_event until it arrives. Reading INR? clears it for the
+    next one. The sweep folds that read into its Vpp query ('INR?;C1:PAVA? PKPK') to save a round trip. If SRQ
+    isn't available (some backends/adapters) enable_acquisition_srq returns False, and a timed out wait raises
+    VisaIOError, so the caller can fall back to polling.
+'''
+
+def enable_acquisition_srq(osc):
+    # Enable the VISA side first, so a backend without SRQ support leaves the scope's status registers alone
+    try:
+        osc.enable_event(constants.EventType.service_request, constants.EventMechanism.queue)
+    except (pyvisa.VisaIOError, NotImplementedError):
+        return False
+    try:
+        osc.write('INE 1;*SRE 1')
+        osc.query('INR?')
+        discard_acquisition_srqs(osc)
+        return True
+    except (pyvisa.VisaIOError, NotImplementedError):
+        disable_acquisition_srq(osc)
+        return False
+
+def disable_acquisition_srq(osc):
+    try:
+        osc.disable_event(constants.EventType.service_request, constants.EventMechanism.queue)
+        osc.write('*SRE 0')
+    except (pyvisa.VisaIOError, NotImplementedError):
+        pass
+
+def discard_acquisition_srqs(osc):
+    # Drop any SRQ still queued from an earlier acquisition, so the next wait is for the one about to be armed
+    osc.discard_events(constants.EventType.service_request, constants.EventMechanism.queue)
+
+def wait_for_acquisition(osc, timeout_ms):
+    with resource_lock(osc):
+        osc.wait_on_event(constants.EventType.service_request, timeout_ms)
+        osc.read_stb()
+
+'''
+    Pull the number out of a raw Siglent reply like b'C1:PAVA PKPK,2.34E+00V\n' (optionally after an 'INR 1;'
+    reply). query_ascii_values can't do this, since the header and unit suffix aren't numbers, so it's a single
+    search with a precompiled pattern on the undecoded bytes. Raises ValueError if the reply has no number in it
+    (the scope sends '****' for a measurement it couldn't make).
+'''
+
+_PKPK_RE = re.compile(rb'PKPK,([-+0-9.Ee]+)V')
+
+def parse_pkpk(reply):
+    match = _PKPK_RE.search(reply)
+    if match is None:
+        raise ValueError(f'No value in reply {reply!r}')
+    return float(match.group(1))
+
+'''
+    Both scopes snap the timebase to the nearest step of a 1-2-5 sequence, so the scale they'll actually use can be
+    worked out here instead of read back with a query. Works on arrays.
+'''
+
+def snap_tdiv(x):
+    x = np.asarray(x, dtype=float)
+    decade = 10.0 ** np.floor(np.log10(x))
+    steps = decade[..., None] * np.array([1.0, 2.0, 5.0, 10.0])
+    nearest = np.abs(steps - x[..., None]).argmin(axis=-1)
+    return np.take_along_axis(steps, nearest[..., None], axis=-1)[..., 0]
+
+'''
+    Independent instruments can be talked to at the same time. Each (instrument, commands) batch is written in order
+    on its own worker thread, so the total time is the slowest batch rather than the sum of all of them. Never put
+    the same instrument in two batches of one call.
+'''
+
+def write_all(inst, commands):
+    with resource_lock(inst):
+        for command in commands:
+            write_command(inst, command)
+
+async def write_concurrently(*batches):
+    await asyncio.gather(*(asyncio.to_thread(write_all, inst, commands) for inst, commands in batches))
+
+def run_coroutine(coro):
+    # asyncio.run, except that inside an already running event loop (Jupyter, VS Code's interactive window) the
+    # coroutine gets its own loop on a worker thread, since asyncio.run can't be nested. Blocks until it's done.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+'''
+    Sweep results are stored in SQLite as each point is measured (committed every few points), so a timeout or a
+    Ctrl-C near the end of a long sweep doesn't lose the whole run. Rows are tagged with a run_id. With resume on,
+    bode_plot picks up the most recent run and only measures the frequencies it doesn't have yet.
+'''
+
+RESULTS_COMMIT_EVERY = 10
+
+def open_results_db(path):
+    # The sweep may write from a worker thread (see run_coroutine), but only ever from one thread at a time
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS sweep(run_id TEXT, freq REAL, vpp REAL, db REAL, t REAL)')
+    return conn
+
+def load_last_run(conn):
+    # Returns (run_id, freqs, vpps) for the most recent run, or (None, empty, empty) if there isn't one. Points
+    # that failed (stored with vpp 0) are left out, so a resumed sweep measures them again.
+    row = conn.execute('SELECT run_id FROM sweep ORDER BY t DESC LIMIT 1').fetchone()
+    if row is None:
+        return None, np.empty(0), np.empty(0)
+    rows = conn.execute('SELECT freq, vpp FROM sweep WHERE run_id = ? AND vpp > 0', (row[0],)).fetchall()
+    done = np.array(rows, dtype=float).reshape(-1, 2)
+    return row[0], done[:, 0], done[:, 1]
 
 ''' 
 
@@ -229,19 +639,33 @@ Note that the Rigol can sometimes produce weird Vpp measurements. There is retry
 
 I have code for Rigol and Siglent scopes here. Note that I'm _not_ using Siglent's Tek compatibility mode.
 
+I looked at using the Siglent's sequence (segmented) capture to grab every point in one go and read the results back
+in one transfer, with the 33511B stepping through a LIST:FREQ sweep on its own. It doesn't fit this sweep:
+- Every segment of a sequence capture shares one timebase, but the timebase here follows the frequency over 6 decades.
+- The segments are taken on consecutive triggers, which for a continuous sine are one cycle apart. Nothing ties them
+  to the generator's frequency steps without an external trigger cable and burst/dwell tuning per setup.
+The Rigol DS1104Z is no better: no segmented memory at all (just the waveform recording option, which has the same
+one-timebase problem), so there's nothing to capture into, and *TRG on a 33511B burst list can't fix that.
+So the per-point arm-and-read loop stays. Sequence mode might still be worth it for a narrow sweep (under a decade,
+one timebase) with the generator's sync output wired to the scope's external trigger. I haven't tried that.
+
 '''
 
 def bode_plot():
-    rm = pyvisa.ResourceManager()
-    # print(rm.list_resources()) # Note: sometimes running the script back-to-back can cause issues with the VISA resource manager, so it's good to check the resources.
-    # NOTE: I wasn't closing the resource manager. Trying that to see if that fixes the issue.
-
-    # Connect to the instruments
-    # dmm = rm.open_resource(DMM_ADDRESS)  # Digital Multimeter
-    pwr = rm.open_resource(POWER_SUPPLY_ADDRESS)  # Power Supply
-    wfg = rm.open_resource(WAVEFORM_GENERATOR_ADDRESS)  # Waveform Generator
-    # osc = rm.open_resource(RIGOL_OSCILLOSCOPE_ADDRESS)  # Rigol Oscilloscope
-    osc = rm.open_resource(SIGLENT_OSCILLOSCOPE_ADDRESS)  # Siglent Oscilloscope
+    # print(get_rm().list_resources()) # Note: sometimes running the script back-to-back can cause issues with the VISA resource manager, so it's good to check the resources.
+    # NOTE: The resource manager and connections are cached and closed at exit (see get_resource above).
+
+    # Connect to the instruments. Each connection can take a couple of seconds to open, so they're opened in parallel.
+    # dmm = get_resource(DMM_ADDRESS)  # Digital Multimeter
+    instruments = open_instruments([
+        ('Power Supply', POWER_SUPPLY_ADDRESS),
+        ('Waveform Generator', WAVEFORM_GENERATOR_ADDRESS),
+        # ('Rigol Oscilloscope', RIGOL_OSCILLOSCOPE_ADDRESS),
+        ('Siglent Oscilloscope', SIGLENT_OSCILLOSCOPE_ADDRESS),
+    ])
+    if instruments is None:
+        return
+    pwr, wfg, osc = instruments
 
     # Circuit and test equipment setup
     supply_voltage = 5.0         # Set the power supply voltage
@@ -253,19 +677,31 @@ def bode_plot():
     error_check_max_gain = 1000  # Maximum gain to check for errors in the Vpp measurement
     scope_v_per_div = 0.5        # Vertical scale for the oscilloscope in V/div (500 mV/div)
     scope_trigger_level = 0.0    # Trigger level for the oscilloscope in V (0 V)
+    use_async_reads = True       # Await scope replies with VISA async reads. Set False for plain blocking queries (e.g. GPIB).
+    use_stream_transport = True  # With a SOCKET scope address, run the sweep's scope traffic over asyncio streams
+    use_srq = True               # Wait for the scope's acquisition-complete SRQ instead of polling TRIG:STAT?
+    results_db = 'bode.sqlite'   # Each point is saved here as it's measured
+    results_npz = 'bode.npz'     # The finished sweep (freqs, vpp, db) is also saved here
+    resume = False               # Continue the last run in results_db, skipping frequencies it already has
+    progress_every = 5           # Print (and flush) the progress lines in batches of this many points...
+    progress_interval = 1.0      # ...or once this many seconds have passed since the last batch, if sooner
 
     # Turn on the function generator output
-    wfg.write('FUNC SIN')
-    wfg.write(f'FREQ {start_freq}')  
-    wfg.write(f'VOLT {vpp_input}') 
-    wfg.write('VOLT:OFFS 0')   # Set offset to 0
-    wfg.write('PHAS 0')        # Set phase to 0
-    wfg.write('OUTP ON')
+    wfg_setup = [
+        'FUNC SIN',
+        f'FREQ {start_freq}',
+        f'VOLT {vpp_input}',
+        'VOLT:OFFS 0',   # Set offset to 0
+        'PHAS 0',        # Set phase to 0
+        'OUTP ON',
+    ]
 
     # Turn on the power supply
-    pwr.write(f'VOLT {supply_voltage}')
-    pwr.write(f'CURR {supply_current_limit}')
-    pwr.write('OUTP ON')
+    pwr_setup = [
+        f'VOLT {supply_voltage}',
+        f'CURR {supply_current_limit}',
+        'OUTP ON',
+    ]
 
     # Run an auto setup on the oscilloscope. This can take a while, so we set a timeout.
     # NOTE: I opted to manually set up the scope instead of using autoset since it can sometimes
@@ -273,15 +709,25 @@ def bode_plot():
     # osc.timeout = 10000
     # osc.write(':AUToscale')
 
-    # RIGOL: Set the oscilloscope to AC coupling and configure the channel.
-    # osc.write(':CHAN1:COUP AC')  
-    # osc.write(f':CHAN1:SCAL {scope_v_per_div}')   
-    # osc.write(f':TRIGger:EDGE:LEV {scope_trigger_level}')
+    # RIGOL: Set the oscilloscope to AC coupling and configure the channel. Normal acquisition doesn't change
+    # during the sweep, so it's set here too. One compound command, one write.
+    # osc.write(f':CHAN1:COUP AC;:CHAN1:SCAL {scope_v_per_div};:TRIGger:EDGE:LEV {scope_trigger_level};:ACQ:TYPE NORM')
 
     # SIGLENT: Set the oscilloscope to AC coupling and configure the channel.
-    osc.write('C1:CPL A1M')  
-    osc.write(f'C1:VDIV {scope_v_per_div}V')   
-    osc.write(f'C1:TRIG_LEVEL {scope_trigger_level}V')
+    osc_setup = [
+        'C1:CPL A1M',
+        f'C1:VDIV {scope_v_per_div}V',
+        f'C1:TRIG_LEVEL {scope_trigger_level}V',
+        'ACQW SAMPLING',  # Normal acquisition. Doesn't change during the sweep.
+    ]
+
+    # The three instruments are independent, so set them up concurrently. Each setup goes out as one compound
+    # command in a single write. The Keysight commands are re-rooted with ';:' so e.g. OUTP isn't parsed under VOLT.
+    run_coroutine(write_concurrently(
+        (wfg, [';:'.join(wfg_setup)]),
+        (pwr, [';:'.join(pwr_setup)]),
+        (osc, [';'.join(osc_setup)]),
+    ))
 
     # Calculate number of decades and points to collect per decade
     decades = np.log10(end_freq) - np.log10(start_freq)
@@ -290,146 +736,260 @@ def bode_plot():
     # Generate logarithmically spaced frequency points
     freqs = np.logspace(np.log10(start_freq), np.log10(end_freq), total_points)
 
-    # Frequency sweep and measurement
-    vpp_measurements = []
-    db_measurements = []
-    for freq in freqs:
-        # Set the frequency on the waveform generator and wait for it to settle
-        wfg.write(f'FREQ {freq}')
-        print(f'Frequency: {freq:.2f} Hz, ',end='', flush=True)
-
-        # -------------------------------------------------------------------------------------
-        # RIGOL. Not modified for Siglent.
-        # Version 1: Capturing with a 200 ms delay to allow settling time
-        # TODO: fix horizontal scale based on frequency - also doesn't have the retry logic
-        # -------------------------------------------------------------------------------------
-        # osc.write('MEAS:CLEAR')              # Clear previous measurements
-        # osc.write(':RUN')                    # Start acquisition
-        # time.sleep(0.2)                      # Allow measurement to settle
-        # osc.write(':STOP')                   # Stop acquisition
-        # vpp = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))  # Read the Vpp measurement
-
-        # -------------------------------------------------------------------------------------
-        # RIGOL. Not modified for Siglent.
-        # Version 2: Taking multiple measurements and make sure they're withing 5% of each other.
-        # TODO: fix horizontal scale based on frequency - retry logic below is better.
-        # -------------------------------------------------------------------------------------
-        # osc.write('MEAS:CLEAR')              # Clear previous measurements
-        # osc.write(':RUN')                    # Start acquisition
-        # time.sleep(0.2)                      # Allow measurement to settle
-        # max_attempts=5                       # Number of attempts to measure Vpp
-        # error_threshold = 0.05               # 5% error threshold
-        # measurements = []
-        # vpp = 0.0
-        # for i in range(max_attempts):
-        #     vpp_temp = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))
-        #     measurements.append(vpp_temp)
-        #     if i > 0:
-        #         if abs(measurements[-1] - measurements[-2]) / measurements[-2] < error_threshold: 
-        #             vpp = vpp_temp
-        #             break
-        #         else:
-        #             vpp = sum(measurements) / len(measurements) 
-        #     time.sleep(0.1)
-        # osc.write(':STOP')                   # Stop acquisition
-
-        # -------------------------------------------------------------------------------------
-        # Version 3: Capturing with single acquisition mode. This is the fastest.
-        # -------------------------------------------------------------------------------------
-        horizontal_scale = max(10/freq, 100e-6)
-
-        # RIGOL: Set horizontal scale
-        # osc.write(f":TIM:SCAL {horizontal_scale}")
-        # actual_horizontal_scale = float(osc.query(":TIM:SCAL?"))
-        # osc.write("ACQ:TYPE NORM")  # Normal acquisition
-        # osc.write("SING")           # Single acquisition
-        # time.sleep(0.1)             # Allow measurement to settle. This reduces bad readings.
-        # osc.write(':MEAS:CLEAR')    # Clear previous measurements
-
-        # Siglent: Set horizontal scale
-        osc.write(f"TDIV {horizontal_scale}")
-        tdiv_response = osc.query("TDIV?")
-        tdiv_response = tdiv_response.strip() # Remove /n from end
-        actual_horizontal_scale = float(tdiv_response.rstrip('S'))  # Remove 'S' and convert to float
-        osc.write("ACQW SAMPLING")  # Normal acquisition
-        osc.write("ARM")            # Single acquisition
-        time.sleep(0.1)             # Allow measurement to settle. This reduces bad readings.
-        osc.write('PARAMETER_CLR')  # Clear previous measurements
-
-        # RIGOL:Take multiple Vpp measurements and check for validity
-        # max_attempts = 5
-        # vpp = None
-        # for attempt in range(max_attempts):
-        #     while True:
-        #         status = osc.query("TRIG:STAT?").strip()
-        #         if status == "STOP":
-        #             break
-        #         time.sleep(0.05)
-        #     try:
-        #         vpp_candidate = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))
-        #     except Exception:
-        #         vpp_candidate = 0.0
-        #     # Check for obviously erroneous values (zero, negative, or unreasonably high)
-        #     if vpp_candidate > 0 and vpp_candidate < error_check_max_gain * vpp_input:
-        #         vpp = vpp_candidate
-        #         break
-        #     else:
-        #         print(f"Warning: Invalid Vpp measurement ({vpp_candidate}), retrying...")
-        #         time.sleep(0.1)
-        #         osc.write("SING")
-        #         time.sleep(0.1)
-        # if vpp is None:
-        #     print("Warning: Could not get valid Vpp measurement, setting to 0")
-        #     vpp = 0.0
-
-        # Siglent: Take multiple Vpp measurements and check for validity
-        max_attempts = 5
-        vpp = None
-        for attempt in range(max_attempts):
+    # Horizontal scale and settle time for every point, worked out up front as arrays
+    hscales = np.maximum(10 / freqs, 100e-6)
+    actual_hscales = snap_tdiv(hscales)  # What the scope will actually set (for the progress output)
+    # A few divisions' worth, floored for the scope's arming overhead and capped at the old fixed 100 ms
+    settle_times = np.clip(3 * hscales, 5e-3, 0.1)
+
+    # Per-point commands, pre-encoded (see encode_command above). The numbers are %-formatted straight into bytes,
+    # and the frequency and timebase commands are built for every point before the sweep starts.
+    freq_cmd = encode_command(wfg, 'FREQ %.9e')
+    tdiv_arm_cmd = encode_command(osc, 'TDIV %.9e;ARM')
+    freq_cmds = [freq_cmd % f for f in freqs.tolist()]
+    tdiv_arm_cmds = [tdiv_arm_cmd % h for h in hscales.tolist()]
+    arm_cmd = encode_command(osc, 'ARM')
+    parameter_clr_cmd = encode_command(osc, 'PARAMETER_CLR')
+    trig_stat_cmd = encode_command(osc, 'TRIG:STAT?')
+
+    # Frequency sweep and measurement. dB is computed for the whole array after the sweep.
+    vpp_measurements = np.empty(total_points)
+    todo = np.arange(total_points)
+    log_vpp_input = math.log10(abs(vpp_input))  # dB = 20 * (log10(vpp) - log_vpp_input), hoisted out of the loop
+
+    conn = open_results_db(results_db)
+    run_id = None
+    if resume:
+        run_id, done_freqs, done_vpps = load_last_run(conn)
+        if run_id is not None:
+            if done_freqs.size:
+                match = np.isclose(freqs[:, None], done_freqs[None, :], rtol=1e-9, atol=0)
+                have = match.any(axis=1)
+                vpp_measurements[have] = done_vpps[match.argmax(axis=1)[have]]
+            else:
+                have = np.zeros(total_points, bool)  # Every point in the last run failed
+            todo = np.flatnonzero(~have)
+            print(f'Resuming run {run_id}: {have.sum()} of {total_points} points already measured')
+    if run_id is None:
+        # The suffix keeps two sweeps started in the same second (e.g. back to back in one session) apart
+        run_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:8]
+
+    # The sweep runs as a coroutine so the scope replies can be awaited (see AsyncQuery and ScpiStream above)
+    async def sweep(osc_link):
+        if len(todo) and todo[0] != 0:
+            wfg.write_raw(freq_cmds[todo[0]])  # Resuming partway through, so the setup frequency is wrong
+        progress = []
+        last_progress = time.monotonic()
+        for k, i in enumerate(todo):
+            freq = freqs[i]
+
+            # -------------------------------------------------------------------------------------
+            # RIGOL. Not modified for Siglent.
+            # Version 1: Capturing with a 200 ms delay to allow settling time
+            # TODO: fix horizontal scale based on frequency - also doesn't have the retry logic
+            # -------------------------------------------------------------------------------------
+            # osc.write('MEAS:CLEAR')              # Clear previous measurements
+            # osc.write(':RUN')                    # Start acquisition
+            # time.sleep(0.2)                      # Allow measurement to settle
+            # osc.write(':STOP')                   # Stop acquisition
+            # vpp = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))  # Read the Vpp measurement
+
+            # -------------------------------------------------------------------------------------
+            # RIGOL. Not modified for Siglent.
+            # Version 2: Taking multiple measurements and make sure they're withing 5% of each other.
+            # TODO: fix horizontal scale based on frequency - retry logic below is better.
+            # -------------------------------------------------------------------------------------
+            # osc.write('MEAS:CLEAR')              # Clear previous measurements
+            # osc.write(':RUN')                    # Start acquisition
+            # time.sleep(0.2)                      # Allow measurement to settle
+            # max_attempts=5                       # Number of attempts to measure Vpp
+            # error_threshold = 0.05               # 5% error threshold
+            # measurements = []
+            # vpp = 0.0
+            # for i in range(max_attempts):
+            #     vpp_temp = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))
+            #     measurements.append(vpp_temp)
+            #     if i > 0:
+            #         if abs(measurements[-1] - measurements[-2]) / measurements[-2] < error_threshold: 
+            #             vpp = vpp_temp
+            #             break
+            #         else:
+            #             vpp = sum(measurements) / len(measurements) 
+            #     time.sleep(0.1)
+            # osc.write(':STOP')                   # Stop acquisition
+
+            # -------------------------------------------------------------------------------------
+            # Version 3: Capturing with single acquisition mode. This is the fastest.
+            # -------------------------------------------------------------------------------------
+            horizontal_scale = hscales[i]
+            settle_time = settle_times[i]
+
+            actual_horizontal_scale = actual_hscales[i]
+
+            # RIGOL: Set horizontal scale and start a single acquisition in one write
+            # osc.write(f":TIM:SCAL {horizontal_scale};:SING")
+            # time.sleep(settle_time)     # Allow measurement to settle. This reduces bad readings.
+            # osc.write(':MEAS:CLEAR')    # Clear previous measurements
+
+            # Siglent: Set horizontal scale and start a single acquisition in one write, with nothing to wait for.
+            # The waveform generator is already at this frequency: it's set by the setup for the first point, and
+            # while the previous point's Vpp is read for the rest (see below).
+            if srq_enabled:
+                discard_acquisition_srqs(osc)
+            osc_link.write_raw(tdiv_arm_cmds[i])
+            await asyncio.sleep(settle_time)       # Allow measurement to settle. This reduces bad readings.
+            osc_link.write_raw(parameter_clr_cmd)  # Clear previous measurements
+
+            # RIGOL:Take multiple Vpp measurements and check for validity. This keeps polling TRIG:STAT?: on the
+            # DS1104Z *OPC? returns as soon as :SING has been accepted, not when the capture is done, so it can't
+            # replace the poll until a blocking wait has been verified on the hardware.
+            # Note: the scope's measurement statistics (:MEAS:STAT:ITEM? AVER,VPP) don't replace this retry. They
+            # average over acquisitions, and there's only one per point in single mode. A bad reading (the Rigol
+            # returns 9.9E37) would also poison the average instead of being thrown away, so the check stays here.
+            # max_attempts = 5
+            # vpp = None
+            # for attempt in range(max_attempts):
+            #     while True:
+            #         status = osc.query("TRIG:STAT?").strip()
+            #         if status == "STOP":
+            #             break
+            #         time.sleep(0.05)
+            #     try:
+            #         vpp_candidate = float(osc.query(':MEAS:ITEM? VPP,CHAN1'))
+            #     except Exception:
+            #         vpp_candidate = 0.0
+            #     # Check for obviously erroneous values (zero, negative, or unreasonably high)
+            #     if vpp_candidate > 0 and vpp_candidate < error_check_max_gain * vpp_input:
+            #         vpp = vpp_candidate
+            #         break
+            #     else:
+            #         print(f"Warning: Invalid Vpp measurement ({vpp_candidate}), retrying...")
+            #         time.sleep(settle_time)
+            #         osc.write("SING")
+            #         time.sleep(settle_time)
+            # if vpp is None:
+            #     print("Warning: Could not get valid Vpp measurement, setting to 0")
+            #     vpp = 0.0
+
+            # Siglent: Take multiple Vpp measurements and check for validity. Retries back off exponentially until a
+            # deadline with room for a few full acquisitions, so high-frequency points fail fast and low-frequency
+            # points get more time.
+            vpp = None
+            attempts = 0
+            retry_delay = 0.02
+            retry_deadline = time.monotonic() + max(0.25, 40 * horizontal_scale)
+            next_freq_cmd = freq_cmds[todo[k + 1]] if k + 1 < len(todo) else None
             while True:
-                status = osc.query("TRIG:STAT?").strip()
-                if status == "Stop":
+                attempts += 1
+                acquired = False
+                if srq_enabled:
+                    try:
+                        # Generous timeout: a full screen is 10 divisions, plus network and trigger slack
+                        await asyncio.to_thread(wait_for_acquisition, osc, int(20 * horizontal_scale * 1000) + 1000)
+                        acquired = True
+                    except pyvisa.VisaIOError:
+                        pass
+                while not acquired:
+                    status = (await osc_link(trig_stat_cmd, raw=True)).strip()
+                    if status == b"Stop":
+                        break
+                    await asyncio.sleep(0.05)
+                try:
+                    if next_freq_cmd is None:
+                        pkpk_reply = await osc_link(pkpk_cmd, raw=True)
+                    else:
+                        # The acquisition is done, so move the waveform generator on to the next frequency while this
+                        # point's Vpp is read back. It's put back below if the reading has to be retried. Both are
+                        # let finish before anything is raised so the generator write can't land after the put back.
+                        pkpk_reply, wfg_result = await asyncio.gather(
+                            osc_link(pkpk_cmd, raw=True),
+                            write_concurrently((wfg, [next_freq_cmd])),
+                            return_exceptions=True,
+                        )
+                        for result in (pkpk_reply, wfg_result):
+                            if isinstance(result, Exception):
+                                raise result
+                    vpp_candidate = parse_pkpk(pkpk_reply)
+                except Exception:
+                    vpp_candidate = 0.0
+                # Check for obviously erroneous values (zero, negative, or unreasonably high)
+                if vpp_candidate > 0 and vpp_candidate < error_check_max_gain * vpp_input:
+                    vpp = vpp_candidate
                     break
-                time.sleep(0.05)
-            try:
-                # String format looks like this: 'C1:PAVA PKPK,2.34E+00V\n'
-                pkpk_str = osc.query('C1:PAVA? PKPK')
-                pkpk_str = pkpk_str.strip()  # Remove \n
-                vpp_candidate = float(pkpk_str.split(',')[1].rstrip('V'))  # Remove 'V' and convert to float
-            except Exception:
-                print("Exception reading Vpp")
-                vpp_candidate = 0.0
-            # Check for obviously erroneous values (zero, negative, or unreasonably high)
-            if vpp_candidate > 0 and vpp_candidate < error_check_max_gain * vpp_input:
-                vpp = vpp_candidate
-                break
-            else:
-                print(f"Warning: Invalid Vpp measurement ({vpp_candidate}), retrying...")
-                time.sleep(0.1)
-                osc.write("ARM")
-                time.sleep(0.1)
-        if vpp is None:
-            print("Warning: Could not get valid Vpp measurement, setting to 0")
-            vpp = 0.0
-
-        # Store the Vpp measurement and convert to dB
-        vpp_measurements.append(vpp)
-        db_measurements.append(20 * np.log10(abs(vpp) / abs(vpp_input)))
-
-        # Show the progress since this can take a while
-        print(f'Horizontal Scale: {actual_horizontal_scale}, Vpp Measurement: {vpp} V')
-    
-    # Close the instrument connections
-    # dmm.close()
-    pwr.close()
-    wfg.close()
-    osc.close()
-
-    # Close the VISA resource manager
-    rm.close()
+                if time.monotonic() > retry_deadline:
+                    break
+                if next_freq_cmd is not None:
+                    wfg.write_raw(freq_cmds[i])
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(2 * retry_delay, 0.2)
+                if srq_enabled:
+                    discard_acquisition_srqs(osc)
+                osc_link.write_raw(arm_cmd)
+                await asyncio.sleep(settle_time)
+            if vpp is None:
+                print(f"Warning: No valid Vpp measurement at {freq:.2f} Hz in {attempts} attempts (last {vpp_candidate}), setting to 0")
+                vpp = 0.0
+
+            # Store the Vpp measurement, in memory and in the results database
+            vpp_measurements[i] = vpp
+            db = 20 * (math.log10(vpp) - log_vpp_input) if vpp > 0 else None
+            conn.execute('INSERT INTO sweep VALUES (?, ?, ?, ?, ?)', (run_id, float(freq), vpp, db, time.time()))
+            if (k + 1) % RESULTS_COMMIT_EVERY == 0:
+                conn.commit()
+
+            # Show the progress since this can take a while. It's printed a few points at a time rather than flushing
+            # the console at every point, but slow low-frequency points still show up within about a second.
+            progress.append(f'Frequency: {freq:.2f} Hz, Horizontal Scale: {actual_horizontal_scale}, Vpp Measurement: {vpp} V')
+            now = time.monotonic()
+            if len(progress) >= progress_every or now - last_progress >= progress_interval or k + 1 == len(todo):
+                print('\n'.join(progress), flush=True)
+                progress.clear()
+                last_progress = now
+
+    stream_scope = use_stream_transport and SIGLENT_OSCILLOSCOPE_ADDRESS.upper().endswith('::SOCKET')
+    osc_query = AsyncQuery(osc, use_async_reads and not stream_scope)
+    srq_enabled = use_srq and not stream_scope and enable_acquisition_srq(osc)
+    pkpk_cmd = encode_command(osc, 'INR?;C1:PAVA? PKPK' if srq_enabled else 'C1:PAVA? PKPK')
+    def release_scope():
+        with resource_lock(osc):
+            osc_query.close()
+            if srq_enabled:
+                disable_acquisition_srq(osc)
+
+    async def run_sweep():
+        if not stream_scope:
+            await sweep(osc_query)
+            return
+        # The setup went out over the VISA connection. Make sure the scope has finished with it, then close it before
+        # the sweep opens its own: many scopes take only one client on the raw socket, and nothing would order
+        # commands across two connections anyway. It's reopened from the pool on the next run.
+        osc.query('*OPC?')
+        release_resource(osc)
+        osc_stream = await ScpiStream.open(SIGLENT_OSCILLOSCOPE_ADDRESS)
+        try:
+            await sweep(osc_stream)
+        finally:
+            await osc_stream.close()
+
+    try:
+        run_coroutine(run_sweep())
+    finally:
+        conn.commit()
+        conn.close()
+        # Releasing the scope's events and SRQ takes a round trip or two. It doesn't touch the results, so it runs in
+        # the background while the plot is built.
+        scope_release = threading.Thread(target=release_scope)
+        scope_release.start()
+
+    # The instrument connections and the VISA resource manager stay open for the next run. They're closed at exit.
+
+    # Convert to dB. A failed point (0 V) comes out as -inf and is left off the plot.
+    with np.errstate(divide='ignore'):
+        db_measurements = 20 * (np.log10(np.abs(vpp_measurements)) - log_vpp_input)
+    np.savez(results_npz, freqs=freqs, vpp=vpp_measurements, db=db_measurements)
 
     # Plot the Bode plot.
-    plt.figure(figsize=(10, 6))
+    fig = plt.figure(figsize=(10, 6))
     # plt.semilogx(freqs, vpp_measurements, marker='o', linestyle='-')
     plt.semilogx(freqs, db_measurements, marker='o', linestyle='-')
     # plt.title('Bode Plot of Vpp vs Frequency')
@@ -443,11 +1003,17 @@ def bode_plot():
     # Set x-ticks at each decade (multiples of 10) with comma separators for thousands
     min_exp = int(np.floor(np.log10(freqs[0])))
     max_exp = int(np.ceil(np.log10(freqs[-1])))
-    decade_ticks = [10**i for i in range(min_exp, max_exp + 1)]
+    decade_ticks = np.logspace(min_exp, max_exp, max_exp - min_exp + 1)
     plt.xticks(decade_ticks, labels=[f'{int(x):,}' for x in decade_ticks])
 
-    plt.tight_layout()
-    plt.show()
+    scope_release.join()
+    if BATCH_MODE:
+        # bbox_inches='tight' trims the figure on save, so there's no separate tight_layout() pass
+        fig.savefig(BODE_PLOT_FILE, dpi=120, bbox_inches='tight')
+        print(f'Saved Bode plot to {BODE_PLOT_FILE}')
+    else:
+        plt.tight_layout()
+        plt.show()
 
 '''
     This is just to check the frequency sweep math.